@@ -13,17 +13,14 @@ bl_info = {
 }
 
 from enum import IntEnum
+import json
 import os
 from pathlib import Path
-import platform
 import re
-import shutil
 import stat
-import subprocess
 import sys
-import threading
+import time
 import typing
-import webbrowser
 
 import bpy
 from bpy.app.handlers import persistent
@@ -44,8 +41,19 @@ if "is_running" not in locals():
     last_scripts_path = ""
     sdk_source = SDKSource.PREFS
 
+# Cached result of get_sdk_path(), which is called on every redraw of
+# the add-on preferences
+SDK_PATH_CACHE_TIMEOUT = 2.0  # seconds
+_sdk_path_cache = {'blend': None, 'envvar': None, 'time': 0.0, 'result': None, 'source': SDKSource.PREFS}
+
+# Info log entry written by Blender when installing an add-on from a file
+_INSTALL_LOG_RE = re.compile(r"^Modules Installed .* from '(.*armory.py)' into", re.MULTILINE)
+INSTALL_LOG_TAIL_SIZE = 4096
+
 
 def get_os():
+    import platform
+
     s = platform.system()
     if s == 'Windows':
         return 'win'
@@ -55,6 +63,33 @@ def get_os():
         return 'linux'
 
 
+def get_config_path() -> str:
+    """Returns the path of the Armory configuration file in Blender's
+    user configuration directory. Unlike the add-on preferences, this
+    file is kept when the add-on is removed or reinstalled.
+    """
+    return os.path.join(bpy.utils.user_resource('CONFIG', path='armory', create=True), 'prefs.json')
+
+
+def read_config() -> dict:
+    try:
+        with open(get_config_path(), 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return config if isinstance(config, dict) else {}
+
+
+def write_config(**values):
+    config = read_config()
+    config.update(values)
+    try:
+        with open(get_config_path(), 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=4)
+    except OSError as err:
+        print("Armory: could not write configuration file:", str(err))
+
+
 def detect_sdk_path():
     """Auto-detect the SDK path after Armory installation."""
     # Do not overwrite the SDK path (this method gets
@@ -65,22 +100,56 @@ def detect_sdk_path():
     if addon_prefs.sdk_path != "":
         return
 
+    # If this file lives inside the SDK (e.g. it is symlinked or Blender
+    # runs it directly from the SDK), the SDK path is simply its parent
+    # directory and there is no need to look at the log
+    module_dir = os.path.dirname(os.path.realpath(__file__))
+    if os.path.isdir(os.path.join(module_dir, 'armory', 'blender')):
+        addon_prefs.sdk_path = module_dir + os.sep
+        return
+
+    # If the add-on was installed again from the SDK used previously,
+    # its armory.py is identical to this file and the saved path can be
+    # used without looking at the log
+    sdk_path = read_config().get('sdk_path', '')
+    if sdk_path != '':
+        import filecmp
+
+        sdk_armory_py = os.path.join(sdk_path, 'armory.py')
+        if os.path.isfile(sdk_armory_py) and filecmp.cmp(sdk_armory_py, __file__, shallow=False):
+            addon_prefs.sdk_path = sdk_path
+            return
+
+    # Otherwise armory.py was copied into the add-on directory, find the
+    # location it was installed from in the info log
     win = bpy.context.window_manager.windows[0]
-    area = win.screen.areas[0]
+    # Use an existing info editor if there is one, otherwise
+    # temporarily turn the first area into an info editor
+    area = next((a for a in win.screen.areas if a.type == 'INFO'), win.screen.areas[0])
     area_type = area.type
-    area.type = "INFO"
-    override = bpy.context.copy()
-    override['window'] = win
-    override['screen'] = win.screen
-    override['area'] = win.screen.areas[0]
-    bpy.ops.info.select_all(override, action='SELECT')
-    bpy.ops.info.report_copy(override)
-    area.type = area_type
+    if area_type != 'INFO':
+        area.type = 'INFO'
+    if hasattr(bpy.context, 'temp_override'):  # Blender 3.2+
+        with bpy.context.temp_override(window=win, screen=win.screen, area=area):
+            bpy.ops.info.select_all(action='SELECT')
+            bpy.ops.info.report_copy()
+    else:
+        override = bpy.context.copy()
+        override['window'] = win
+        override['screen'] = win.screen
+        override['area'] = area
+        bpy.ops.info.select_all(override, action='SELECT')
+        bpy.ops.info.report_copy(override)
+    if area_type != 'INFO':
+        area.type = area_type
     clipboard = bpy.context.window_manager.clipboard
 
     # If armory was installed multiple times in this session,
-    # use the latest log entry.
-    match = re.findall(r"^Modules Installed .* from '(.*armory.py)' into", clipboard, re.MULTILINE)
+    # use the latest log entry. The installation is usually among the
+    # latest reports, so look at the end of the log first.
+    match = _INSTALL_LOG_RE.findall(clipboard[-INSTALL_LOG_TAIL_SIZE:])
+    if not match and len(clipboard) > INSTALL_LOG_TAIL_SIZE:
+        match = _INSTALL_LOG_RE.findall(clipboard)
     if match:
         addon_prefs.sdk_path = os.path.dirname(match[-1])
 
@@ -99,51 +168,42 @@ def set_link_web_server(self, value):
         self['link_web_server'] = value
 
 
-class ArmoryAddonPreferences(AddonPreferences):
-    bl_idname = __name__
+def on_sdk_path_changed(prefs, context):
+    # Keep the last valid path when the field is cleared
+    if prefs.sdk_path != '':
+        write_config(sdk_path=prefs.sdk_path)
+    invalidate_sdk_path_cache()
+    restart_armory(context)
 
-    def sdk_path_update(self, context):
-        if self.skip_update:
-            return
-        self.skip_update = True
-        self.sdk_path = bpy.path.reduce_dirs([bpy.path.abspath(self.sdk_path)])[0] + '/'
-        restart_armory(context)
 
-    def ide_bin_update(self, context):
+def make_path_update(attr: str, add_sep=False, on_change=None):
+    """Returns an update callback for the path property `attr` that
+    normalizes the entered path. If `on_change` is given, it is called
+    with the preferences and the context after the path was updated.
+    """
+    def update(self, context):
         if self.skip_update:
             return
-        self.skip_update = True
-        self.ide_bin = bpy.path.reduce_dirs([bpy.path.abspath(self.ide_bin)])[0]
-
-    def ffmpeg_path_update(self, context):
-        if self.skip_update or self.ffmpeg_path == '':
-            return
-        self.skip_update = True
-        self.ffmpeg_path = bpy.path.reduce_dirs([bpy.path.abspath(self.ffmpeg_path)])[0]
-
-    def renderdoc_path_update(self, context):
-        if self.skip_update or self.renderdoc_path == '':
-            return
-        self.skip_update = True
-        self.renderdoc_path = bpy.path.reduce_dirs([bpy.path.abspath(self.renderdoc_path)])[0]
+        path = getattr(self, attr)
+        if path != '':
+            self.skip_update = True
+            path = os.path.normpath(bpy.path.abspath(path))
+            setattr(self, attr, path + os.sep if add_sep else path)
+        if on_change is not None:
+            on_change(self, context)
+    return update
 
-    def android_sdk_path_update(self, context):
-        if self.skip_update:
-            return
-        self.skip_update = True
-        self.android_sdk_root_path = bpy.path.reduce_dirs([bpy.path.abspath(self.android_sdk_root_path)])[0]
 
-    def android_apk_copy_update(self, context):
-        if self.skip_update:
-            return
-        self.skip_update = True
-        self.android_apk_copy_path = bpy.path.reduce_dirs([bpy.path.abspath(self.android_apk_copy_path)])[0]
+class ArmoryAddonPreferences(AddonPreferences):
+    bl_idname = __name__
 
-    def html5_copy_path_update(self, context):
-        if self.skip_update:
-            return
-        self.skip_update = True
-        self.html5_copy_path = bpy.path.reduce_dirs([bpy.path.abspath(self.html5_copy_path)])[0]
+    sdk_path_update = make_path_update('sdk_path', add_sep=True, on_change=on_sdk_path_changed)
+    ide_bin_update = make_path_update('ide_bin')
+    ffmpeg_path_update = make_path_update('ffmpeg_path')
+    renderdoc_path_update = make_path_update('renderdoc_path')
+    android_sdk_path_update = make_path_update('android_sdk_root_path')
+    android_apk_copy_update = make_path_update('android_apk_copy_path')
+    html5_copy_path_update = make_path_update('html5_copy_path')
 
     sdk_path: StringProperty(name="SDK Path", subtype="FILE_PATH", update=sdk_path_update, default="")
 
@@ -300,9 +360,11 @@ class ArmoryAddonPreferences(AddonPreferences):
 
         layout.prop(self, "sdk_path")
         sdk_path = get_sdk_path(context)
-        if os.path.exists(sdk_path + '/armory') or os.path.exists(sdk_path + '/armory_backup'):
-            sdk_exists = True
-        else:
+        # List the SDK directory once instead of checking each entry
+        try:
+            with os.scandir(sdk_path) as it:
+                sdk_exists = any(entry.name in ('armory', 'armory_backup') for entry in it)
+        except OSError:
             sdk_exists = False
         if not sdk_exists:
             layout.label(text="The directory will be created.")
@@ -402,9 +464,7 @@ class ArmoryAddonPreferences(AddonPreferences):
 def get_fp():
     if bpy.data.filepath == '':
         return ''
-    s = bpy.data.filepath.split(os.path.sep)
-    s.pop()
-    return os.path.sep.join(s)
+    return os.path.dirname(bpy.data.filepath)
 
 
 def same_path(path1: str, path2: str) -> bool:
@@ -431,39 +491,96 @@ def get_sdk_path(context: bpy.context) -> str:
     global sdk_source
 
     sdk_envvar = os.environ.get('ARMSDK')
-    if sdk_envvar is not None and os.path.isabs(sdk_envvar) and os.path.isdir(sdk_envvar) and os.path.exists(sdk_envvar):
-        sdk_source = SDKSource.ENV_VAR
-        return sdk_envvar
+    cache = _sdk_path_cache
+    now = time.monotonic()
+    # The lookup below touches the filesystem, only redo it if the
+    # inputs changed or the cached result is outdated
+    if (cache['blend'] != bpy.data.filepath or cache['envvar'] != sdk_envvar
+            or now - cache['time'] > SDK_PATH_CACHE_TIMEOUT):
+        cache['blend'] = bpy.data.filepath
+        cache['envvar'] = sdk_envvar
+        cache['time'] = now
+        cache['result'], cache['source'] = _find_sdk_path(sdk_envvar)
+
+    sdk_source = cache['source']
+    if cache['result'] is not None:
+        return cache['result']
+
+    preferences = context.preferences
+    addon_prefs = preferences.addons["armory"].preferences
+    return addon_prefs.sdk_path
+
+
+def _find_sdk_path(sdk_envvar: typing.Optional[str]) -> typing.Tuple[typing.Optional[str], SDKSource]:
+    """Returns the SDK path from the environment variable or the local
+    SDK next to the blend file together with its source. The returned
+    path is None if the SDK path from the preferences should be used.
+    """
+    if sdk_envvar is not None and os.path.isabs(sdk_envvar) and os.path.isdir(sdk_envvar):
+        return sdk_envvar, SDKSource.ENV_VAR
 
     fp = get_fp()
     if fp != '':  # blend file is not saved
         local_sdk = os.path.join(fp, 'armsdk')
         if os.path.exists(local_sdk):
-            sdk_source = SDKSource.LOCAL
-            return local_sdk
+            return local_sdk, SDKSource.LOCAL
 
-    sdk_source = SDKSource.PREFS
-    preferences = context.preferences
-    addon_prefs = preferences.addons["armory"].preferences
-    return addon_prefs.sdk_path
+    return None, SDKSource.PREFS
 
 
-def remove_readonly(func, path, excinfo):
-    os.chmod(path, stat.S_IWRITE)
-    func(path)
+def invalidate_sdk_path_cache():
+    _sdk_path_cache['time'] = 0.0
 
-def run_proc(cmd, done=None):
-    def fn(p, done):
-        p.wait()
-        if done != None:
-            done(0)
-    p = None
+
+def is_link(st: os.stat_result) -> bool:
+    """Returns whether the given (not followed) stat result belongs to
+    a symbolic link or another reparse point such as a Windows junction,
+    which os.path.islink() does not detect before Python 3.12.
+    """
+    if stat.S_ISLNK(st.st_mode):
+        return True
+    return bool(getattr(st, 'st_file_attributes', 0) & getattr(stat, 'FILE_ATTRIBUTE_REPARSE_POINT', 0))
+
+
+def remove_tree(path: str):
+    """Recursively delete the given directory. Unlike shutil.rmtree()
+    this uses the file type information returned by os.scandir() and
+    also removes read-only files (e.g. git objects on Windows).
+
+    Links inside the tree are removed without touching their targets,
+    and like shutil.rmtree() the root itself must not be a link.
+    """
+    if is_link(os.lstat(path)):
+        raise OSError(f'Cannot remove a symbolic link as directory tree: {path}')
+
+    with os.scandir(path) as it:
+        for entry in it:
+            # Junctions count as directories here, check for reparse
+            # points on Windows (the stat result comes with the listing)
+            if entry.is_dir(follow_symlinks=False) and not (
+                    os.name == 'nt' and is_link(entry.stat(follow_symlinks=False))):
+                remove_tree(entry.path)
+            else:
+                try:
+                    os.unlink(entry.path)
+                except PermissionError:
+                    os.chmod(entry.path, stat.S_IWRITE)
+                    os.unlink(entry.path)
+    try:
+        os.rmdir(path)
+    except PermissionError:
+        os.chmod(path, stat.S_IWRITE)
+        os.rmdir(path)
+
+def run_proc(cmd) -> bool:
+    """Run the given command and block until it has finished. Returns
+    whether the command exited successfully.
+    """
+    import subprocess
 
     try:
-        p = subprocess.Popen(cmd)
+        p = subprocess.run(cmd)
     except OSError as err:
-        if done != None:
-            done(1)
         print("Running command:", *cmd, "\n")
         if err.errno == 12:
             print("Make sure there is enough space for the SDK (at least 500mb)")
@@ -472,27 +589,62 @@ def run_proc(cmd, done=None):
         else:
             print("error: " + str(err))
     except Exception as err:
-        if done != None:
-            done(1)
         print("Running command:", *cmd, "\n")
         print("error:", str(err), "\n")
     else:
-        threading.Thread(target=fn, args=(p, done)).start()
+        return p.returncode == 0
 
-    return p
+    return False
 
-def git_clone(done, p, gitn, n, recursive=False):
-    path = p + '/' + n
-    if os.path.exists(path) and not os.path.exists(path + '_backup'):
-        os.rename(path, path + '_backup')
-    if os.path.exists(path):
-        shutil.rmtree(path, onerror=remove_readonly)
+def git_update(path, recursive=False) -> bool:
+    """Update an existing shallow clone to the latest commit of its
+    remote, only downloading what has changed.
+    """
+    if not run_proc(['git', '-C', path, 'fetch', '--depth', '1', 'origin']):
+        return False
+    if not run_proc(['git', '-C', path, 'reset', '--hard', 'FETCH_HEAD']):
+        return False
     if recursive:
-        run_proc(['git', 'clone', '--recursive', 'https://github.com/' + gitn, path, '--depth', '1', '--shallow-submodules', '--jobs', '4'], done)
+        return run_proc(['git', '-C', path, 'submodule', 'update', '--init', '--recursive', '--depth', '1', '--jobs', '8'])
+    return True
+
+def git_clone(p, gitn, n, recursive=False) -> bool:
+    path = os.path.normpath(os.path.join(p, n))
+    backup_path = path + '_backup'
+    backup_exists = os.path.exists(backup_path)
+    # If the stable version was already backed up by a previous update,
+    # the repository is our own clone and can be updated in place
+    # (submodules of the SDK repository have a .git file instead)
+    if backup_exists and os.path.isdir(os.path.join(path, '.git')):
+        if git_update(path, recursive):
+            return True
+        print(f'Updating {n} failed, cloning it again')
+    renamed = False
+    if not backup_exists:
+        try:
+            os.rename(path, backup_path)
+            renamed = True
+        except FileNotFoundError:
+            pass
+    if not renamed and os.path.exists(path):
+        remove_tree(path)
+    if recursive:
+        return run_proc(['git', 'clone', '--recursive', 'https://github.com/' + gitn, path, '--depth', '1', '--shallow-submodules', '--jobs', '8'])
     else:
-        run_proc(['git', 'clone', 'https://github.com/' + gitn, path, '--depth', '1'], done)
+        return run_proc(['git', 'clone', 'https://github.com/' + gitn, path, '--depth', '1'])
+
+_GIT_VERSION_RE = re.compile(rb"git version [0-9]+\.[0-9]+\.[0-9]+")
+_git_ok = False
 
 def git_test():
+    global _git_ok
+    import subprocess
+
+    # A working git stays working for the rest of the session. A failed
+    # test is repeated so that git can be installed without restarting.
+    if _git_ok:
+        return True
+
     print('Testing if git is working...')
     try:
         p = subprocess.Popen(['git','--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -500,16 +652,19 @@ def git_test():
     except (OSError, Exception) as exception:
         print(str(exception))
     else:
-        if re.match("git version [0-9]+.[0-9]+.[0-9]+", output.decode('utf-8')):
+        if _GIT_VERSION_RE.match(output):
             print('Test succeeded.')
+            _git_ok = True
             return True
     return False
 
 def restore_repo(p, n):
-    if os.path.exists(p + '/' + n + '_backup'):
-        if os.path.exists(p + '/' + n):
-            shutil.rmtree(p + '/' + n, onerror=remove_readonly)
-        os.rename(p + '/' + n + '_backup', p + '/' + n)
+    path = os.path.normpath(os.path.join(p, n))
+    backup_path = path + '_backup'
+    if os.path.exists(backup_path):
+        if os.path.exists(path):
+            remove_tree(path)
+        os.rename(backup_path, path)
 
 
 class ArmAddonInstallButton(bpy.types.Operator):
@@ -533,6 +688,8 @@ class ArmAddonUpdateButton(bpy.types.Operator):
         return {"FINISHED"}
 
 def download_sdk(self, context):
+    from concurrent.futures import ThreadPoolExecutor
+
     sdk_path = get_sdk_path(context)
     if sdk_path == "":
         self.report({"ERROR"}, "Configure Armory SDK path first")
@@ -547,34 +704,52 @@ def download_sdk(self, context):
         print("Git test failed. Make sure git is installed (https://git-scm.com/downloads) or is working correctly.")
         self.report({"ERROR"}, "Git test failed. Make sure git is installed (https://git-scm.com/downloads) or is working correctly.")
         return {"CANCELLED"}
-    global repos_updated
-    global repos_total
-    global repos_done
-    repos_updated = 0
-    repos_done = 0
-    repos_total = 9
-    def done(error=0):
-        global repos_updated
-        global repos_total
-        global repos_done
-        repos_done += 1
-        if error == 0:
-            repos_updated += 1
-        if repos_updated == repos_total:
+
+    repos = [
+        ('armory3d/armory', 'armory', False),
+        ('armory3d/iron', 'iron', False),
+        ('armory3d/haxebullet', 'lib/haxebullet', False),
+        ('armory3d/haxerecast', 'lib/haxerecast', False),
+        ('armory3d/zui', 'lib/zui', False),
+        ('armory3d/armory_tools', 'lib/armory_tools', False),
+        ('armory3d/Kromx_bin', 'Krom', False),
+        ('armory3d/Kha', 'Kha', True),
+        ('armory3d/nodejs_bin/', 'nodejs', False),
+    ]
+
+    # Clone all repositories in parallel, the clones are mostly waiting
+    # on the network so they don't compete with each other
+    addon_prefs = ArmoryAddonPreferences.get_prefs()
+    executor = ThreadPoolExecutor(max_workers=addon_prefs.khamake_threads)
+    futures = [executor.submit(git_clone, sdk_path, *repo) for repo in repos]
+    executor.shutdown(wait=False)
+
+    def on_clones_done():
+        """Timer callback, runs on the main thread."""
+        if not all(f.done() for f in futures):
+            return 0.5
+
+        repos_updated = 0
+        for f in futures:
+            if f.exception() is not None:
+                print("error:", str(f.exception()), "\n")
+            elif f.result():
+                repos_updated += 1
+
+        if repos_updated == len(repos):
             update_armory_py(sdk_path)
             print('Armory SDK download completed, please restart Blender..')
-        elif repos_done == repos_total:
-            self.report({"ERROR"}, "Failed downloading Armory SDK, check console for details.")
-    git_clone(done, sdk_path, 'armory3d/armory', 'armory')
-    git_clone(done, sdk_path, 'armory3d/iron', 'iron')
-    git_clone(done, sdk_path, 'armory3d/haxebullet', 'lib/haxebullet')
-    git_clone(done, sdk_path, 'armory3d/haxerecast', 'lib/haxerecast')
-    git_clone(done, sdk_path, 'armory3d/zui', 'lib/zui')
-    git_clone(done, sdk_path, 'armory3d/armory_tools', 'lib/armory_tools')
-    git_clone(done, sdk_path, 'armory3d/Kromx_bin', 'Krom')
-    git_clone(done, sdk_path, 'armory3d/Kha', 'Kha', recursive=True)
-    git_clone(done, sdk_path, 'armory3d/nodejs_bin/', 'nodejs')
+        else:
+            msg = "Failed downloading Armory SDK, check console for details."
+            print(msg)
+            # The operator has already finished, so it can't report the
+            # error anymore. Show it in a popup instead.
+            def draw_error(menu, context):
+                menu.layout.label(text=msg)
+            bpy.context.window_manager.popup_menu(draw_error, title="Armory SDK", icon='ERROR')
+        return None
 
+    bpy.app.timers.register(on_clones_done, first_interval=0.5, persistent=True)
 
 class ArmAddonRestoreButton(bpy.types.Operator):
     """Update Armory SDK"""
@@ -608,6 +783,7 @@ class ArmAddonHelpButton(bpy.types.Operator):
     bl_description = "Git is required for Armory Updater to work"
 
     def execute(self, context):
+        import webbrowser
         webbrowser.open('https://github.com/armory3d/armory/wiki/gitversion')
         return {"FINISHED"}
 
@@ -619,6 +795,8 @@ def update_armory_py(sdk_path: str, force_relink=False):
     is already loaded as a Python module, this change lags one add-on
     reload behind.
     """
+    import shutil
+
     addon_prefs = ArmoryAddonPreferences.get_prefs()
     arm_module_file = Path(sys.modules['armory'].__file__)
 
@@ -727,29 +905,33 @@ class ArmReloadBlenderAddon(bpy.types.Operator):
 
 global isHotReloading
 isHotReloading = False
+
+classes = (
+    ArmoryAddonPreferences,
+    ArmAddonInstallButton,
+    ArmAddonUpdateButton,
+    ArmAddonRestoreButton,
+    ArmAddonHelpButton,
+    ArmReloadBlenderAddon,
+)
+register_classes, unregister_classes = bpy.utils.register_classes_factory(classes)
+
+
 def register():
-    bpy.utils.register_class(ArmoryAddonPreferences)
-    bpy.utils.register_class(ArmAddonInstallButton)
-    bpy.utils.register_class(ArmAddonUpdateButton)
-    bpy.utils.register_class(ArmAddonRestoreButton)
-    bpy.utils.register_class(ArmAddonHelpButton)
-    bpy.utils.register_class(ArmReloadBlenderAddon)
+    register_classes()
     bpy.app.handlers.load_post.append(on_load_post)
 
-    # Hack to avoid _RestrictContext
+    # Hack to avoid _RestrictContext: during registration bpy.data is
+    # not accessible (needed by get_sdk_path() to find a local SDK) and
+    # there is no window for the info log lookup in detect_sdk_path(),
+    # so defer both to the first timer tick
     bpy.app.timers.register(on_register_post, first_interval=0.01)
 
 
 def unregister():
     stop_armory()
-    bpy.utils.unregister_class(ArmoryAddonPreferences)
-    bpy.utils.unregister_class(ArmAddonInstallButton)
-    bpy.utils.unregister_class(ArmAddonUpdateButton)
-    bpy.utils.unregister_class(ArmAddonRestoreButton)
-    bpy.utils.unregister_class(ArmAddonHelpButton)
-    bpy.utils.unregister_class(ArmReloadBlenderAddon)
+    unregister_classes()
     bpy.app.handlers.load_post.remove(on_load_post)
 
-
 if __name__ == "__main__":
     register()